@@ -1,19 +1,44 @@
 import os
 import sys
-import json
+import ast
+import errno
+import gzip
+import mimetypes
 import importlib
 import traceback
 import sqlite3
 import hashlib
+import asyncio
+import atexit
+import queue
+import threading
+import time
+import uuid
+import aiofiles
+import aiofiles.os
+import orjson
+from concurrent.futures import Future
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate
+from functools import lru_cache
+from pathlib import Path
+from stat import S_ISREG
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, APIRouter, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from threading import Thread
-from time import sleep
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
 
-# Correctly import the completion function from LiteLLM
-from litellm import completion, supports_function_calling
+# BLAKE3 is optional; code IDs fall back to SHA-256 when it isn't installed
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+# Correctly import the async completion function from LiteLLM
+from litellm import acompletion, get_llm_provider, supports_function_calling
 
 # Configuration
 MODEL_NAME = os.environ.get('LITELLM_MODEL', 'gpt-4o')  # Default model; can be swapped easily
@@ -21,19 +46,115 @@ MODEL_NAME = os.environ.get('LITELLM_MODEL', 'gpt-4o')  # Default model; can be
 # Initialize FastAPI app
 app = FastAPI()
 
+# Static files up to this size are kept in memory; larger ones are sent with sendfile via FileResponse
+STATIC_CACHE_MAX_FILE_SIZE = 1024 * 1024
+STATIC_CACHE_SIZE = 256
+
+def accepts_gzip(accept_encoding):
+    # An explicit gzip entry wins over "*"; a q-value of 0 means "not acceptable"
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+def is_not_modified(request_headers, etag, last_modified):
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    # If-Modified-Since only applies when no If-None-Match was sent
+    if_modified_since = parsedate(request_headers.get("if-modified-since", ""))
+    return if_modified_since is not None and if_modified_since >= parsedate(last_modified)
+
+# StaticFiles that serves small assets from an in-memory LRU of raw and gzipped bodies
+class CachedStaticFiles(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = LRUCache(maxsize=STATIC_CACHE_SIZE)
+
+    async def load_entry(self, full_path, stat_result):
+        async with aiofiles.open(full_path, 'rb') as f:
+            body = await f.read()
+        etag = hashlib.sha256(body).hexdigest()
+        entry = {
+            "mtime": stat_result.st_mtime,
+            "media_type": mimetypes.guess_type(full_path)[0] or "text/plain",
+            "last_modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "body": body,
+            "etag": f'"{etag}"',
+            "body_gz": None,
+            "etag_gz": f'"{etag}-gzip"'
+        }
+        body_gz = await asyncio.to_thread(gzip.compress, body)
+        # Only keep the compressed variant when it actually saves bytes
+        if len(body_gz) < len(body):
+            entry["body_gz"] = body_gz
+        self.cache[full_path] = entry
+        return entry
+
+    async def get_response(self, path, scope):
+        # Other methods get the base class's 405
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        # Map lookup errors the same way StaticFiles does
+        try:
+            full_path, stat_result = await asyncio.to_thread(self.lookup_path, path)
+        except PermissionError:
+            raise HTTPException(status_code=401)
+        except OSError as exc:
+            if exc.errno == errno.ENAMETOOLONG:
+                raise HTTPException(status_code=404)
+            raise exc
+
+        if (
+            stat_result is None
+            or not S_ISREG(stat_result.st_mode)
+            or stat_result.st_size > STATIC_CACHE_MAX_FILE_SIZE
+        ):
+            return await super().get_response(path, scope)
+
+        entry = self.cache.get(full_path)
+        if entry is None or entry["mtime"] != stat_result.st_mtime:
+            entry = await self.load_entry(full_path, stat_result)
+
+        request_headers = Headers(scope=scope)
+        body, etag = entry["body"], entry["etag"]
+        headers = {"Last-Modified": entry["last_modified"], "Vary": "Accept-Encoding"}
+        if entry["body_gz"] is not None and accepts_gzip(request_headers.get("accept-encoding", "")):
+            body, etag = entry["body_gz"], entry["etag_gz"]
+            headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = etag
+
+        if is_not_modified(request_headers, etag, entry["last_modified"]):
+            headers.pop("Content-Encoding", None)
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type=entry["media_type"], headers=headers)
+
 # Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 # Templates directory
 templates = Jinja2Templates(directory="templates")
 
-LOG_FILE = "logs/fastapi_app_builder_log.json"
+LOG_FILE = "logs/fastapi_app_builder_log.ndjson"
 
 # Directory paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 ROUTES_DIR = os.path.join(BASE_DIR, 'routes')
+INDEX_FILE = os.path.join(TEMPLATES_DIR, 'index.html')
 
 # Initialize progress tracking
 progress = {
@@ -41,9 +162,34 @@ progress = {
     "iteration": 0,
     "max_iterations": 50,
     "output": "",
-    "completed": False
+    "completed": False,
+    "version": 0
 }
 
+# Every mutation goes through here so the version (and the /progress ETag) changes with it
+def update_progress(**changes):
+    progress.update(changes)
+    progress["version"] += 1
+
+# Keep references to running build tasks so they aren't garbage collected mid-run
+background_tasks = set()
+
+# Each /progress/stream subscriber owns a queue holding only the latest snapshot
+progress_subscribers = set()
+
+# Idle subscribers are re-sent the current state this often, which also acts as a keepalive
+PROGRESS_STREAM_KEEPALIVE = 15  # seconds
+
+# Update progress and push the new snapshot to every subscriber, replacing any snapshot
+# it hasn't read yet; snapshots are cumulative, so only the latest one matters
+def publish_progress(**changes):
+    update_progress(**changes)
+    snapshot = dict(progress)
+    for subscriber in progress_subscribers:
+        if subscriber.full():
+            subscriber.get_nowait()
+        subscriber.put_nowait(snapshot)
+
 # Ensure directories exist and create __init__.py in routes
 def create_directory(path):
     if not os.path.exists(path):
@@ -73,36 +219,57 @@ def update_file(path, content):
     except Exception as e:
         return f"Error updating file {path}: {e}"
 
+# Cache file reads keyed on modification time so an edited file is re-read automatically
+@lru_cache(maxsize=64)
+def _read_cached(path, mtime_ns, size):
+    with open(path, 'r') as f:
+        return f.read()
+
+def read_file(path):
+    stat = os.stat(path)
+    return _read_cached(path, stat.st_mtime_ns, stat.st_size)
+
 def fetch_code(file_path):
     try:
-        with open(file_path, 'r') as f:
-            code = f.read()
-        return code
+        return read_file(file_path)
     except Exception as e:
         return f"Error fetching code from {file_path}: {e}"
 
+# Track route module mtimes and attached routers so repeated loads only touch what changed.
+# include_router keeps no reference to the router, so hold the objects themselves; a bare id()
+# could be reused by a new router once a replaced one is garbage-collected.
+_route_mtimes = {}
+_loaded_routers = set()
+
 def load_routes():
     try:
         if BASE_DIR not in sys.path:
             sys.path.append(BASE_DIR)
-        for filename in os.listdir(ROUTES_DIR):
-            if filename.endswith('.py') and filename != '__init__.py':
-                module_name = filename[:-3]
-                module_path = f'routes.{module_name}'
-                try:
-                    if module_path in sys.modules:
-                        importlib.reload(sys.modules[module_path])
-                    else:
-                        importlib.import_module(module_path)
-                    module = sys.modules.get(module_path)
-                    if module:
-                        for attr_name in dir(module):
-                            attr = getattr(module, attr_name)
-                            if isinstance(attr, APIRouter):
-                                app.include_router(attr)
-                except Exception as e:
-                    print(f"Error importing module {module_path}: {e}")
-                    continue
+        with os.scandir(ROUTES_DIR) as entries:
+            for entry in entries:
+                filename = entry.name
+                if filename.endswith('.py') and filename != '__init__.py' and entry.is_file():
+                    module_name = filename[:-3]
+                    module_path = f'routes.{module_name}'
+                    try:
+                        mtime = entry.stat().st_mtime_ns
+                        if _route_mtimes.get(module_path) == mtime:
+                            continue
+                        if module_path in sys.modules:
+                            importlib.reload(sys.modules[module_path])
+                        else:
+                            importlib.import_module(module_path)
+                        module = sys.modules.get(module_path)
+                        if module:
+                            for attr_name in dir(module):
+                                attr = getattr(module, attr_name)
+                                if isinstance(attr, APIRouter) and attr not in _loaded_routers:
+                                    app.include_router(attr)
+                                    _loaded_routers.add(attr)
+                        _route_mtimes[module_path] = mtime
+                    except Exception as e:
+                        print(f"Error importing module {module_path}: {e}")
+                        continue
         print("Routes loaded successfully.")
         return "Routes loaded successfully."
     except Exception as e:
@@ -110,8 +277,7 @@ def load_routes():
         return f"Error loading routes: {e}"
 
 def task_completed():
-    progress["status"] = "completed"
-    progress["completed"] = True
+    update_progress(status="completed", completed=True)
     return "Task marked as completed."
 
 # Initialize necessary directories
@@ -122,117 +288,313 @@ create_directory(ROUTES_DIR)  # This will also create __init__.py in routes
 # Load routes once at initiation
 load_routes()
 
-# Function to log history to file
-def log_to_file(history_dict):
+# Open the iteration log once per run in append mode; logging is best-effort
+def open_log():
+    try:
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        return open(LOG_FILE, 'ab')
+    except Exception:
+        return open(os.devnull, 'ab')
+
+# Function to append a single entry to the log as one JSON line, tagged with its run so
+# lines from different runs sharing the file can be told apart
+def log_to_file(log_file, run_id, entry):
     try:
-        with open(LOG_FILE, 'w') as log_file:
-            json.dump(history_dict, log_file, indent=4)
+        log_file.write(orjson.dumps({"run_id": run_id, **entry}, default=str) + b"\n")
+        log_file.flush()
     except Exception as e:
         pass  # Silent fail
 
+# The generated index.html only appears once per build, so stat results can be briefly cached
+_stat_cache = TTLCache(maxsize=16, ttl=1)
+
+async def cached_stat(path):
+    try:
+        return _stat_cache[path]
+    except KeyError:
+        pass
+    try:
+        stat = await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        stat = None
+    _stat_cache[path] = stat
+    return stat
+
+# Generated index.html is served from memory with precomputed cache validators
+_index_cache = {}
+
+def cache_index(body, mtime):
+    _index_cache.update({
+        "body": body,
+        "mtime": mtime,
+        "etag": f'"{hashlib.sha256(body).hexdigest()}"',
+        "last_modified": formatdate(mtime, usegmt=True)
+    })
+
+def load_index():
+    try:
+        mtime = os.path.getmtime(INDEX_FILE)
+        with open(INDEX_FILE, 'rb') as f:
+            cache_index(f.read(), mtime)
+    except OSError:
+        pass
+
+async def get_index():
+    stat = await cached_stat(INDEX_FILE)
+    if stat is None:
+        return None
+    # Re-read only when the file has changed since it was cached
+    if _index_cache.get("mtime") != stat.st_mtime:
+        try:
+            async with aiofiles.open(INDEX_FILE, 'rb') as f:
+                cache_index(await f.read(), stat.st_mtime)
+        except FileNotFoundError:
+            return None
+    return _index_cache
+
+def index_response(request, index):
+    headers = {
+        "ETag": index["etag"],
+        "Last-Modified": index["last_modified"],
+        "Cache-Control": "public, max-age=60"
+    }
+    if is_not_modified(request.headers, index["etag"], index["last_modified"]):
+        return Response(status_code=304, headers=headers)
+    return Response(index["body"], media_type="text/html", headers=headers)
+
+# Prime the index cache at startup if a previous build already generated one
+load_index()
+
 # Default route to serve generated index.html or render a form
 @app.get("/", response_class=HTMLResponse)
+async def home_get(request: Request):
+    index = await get_index()
+    if index:
+        return index_response(request, index)
+    return templates.TemplateResponse("form.html", {"request": request})
+
+# Route to start building the application from the submitted description
 @app.post("/", response_class=HTMLResponse)
-async def home(request: Request):
-    index_file = os.path.join(TEMPLATES_DIR, 'index.html')
-    if os.path.exists(index_file):
-        return FileResponse(index_file)
-    else:
-        if request.method == 'POST':
-            user_input = (await request.form())['user_input']
-            progress["status"] = "running"
-            progress["iteration"] = 0
-            progress["output"] = ""
-            progress["completed"] = False
-            thread = Thread(target=run_main_loop, args=(user_input,))
-            thread.start()
-            return templates.TemplateResponse("progress.html", {"request": request, "progress_output": progress["output"]})
-        else:
-            return templates.TemplateResponse("form.html", {"request": request})
+async def home_post(request: Request, user_input: str = Form(...)):
+    index = await get_index()
+    if index:
+        return index_response(request, index)
+    update_progress(status="running", iteration=0, output="", completed=False)
+    task = asyncio.create_task(run_main_loop(user_input))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return templates.TemplateResponse("progress.html", {"request": request, "progress_output": progress["output"]})
+
+# Serialized progress is reused until the version changes; the epoch keeps ETags
+# from a previous server process from matching after a restart
+_progress_epoch = f"{time.time_ns():x}"
+_progress_cache = {"version": None, "body": b""}
 
 # Route to provide progress updates
 @app.get("/progress", response_class=JSONResponse)
-async def get_progress():
-    return JSONResponse(content=progress)
+async def get_progress(request: Request):
+    version = progress["version"]
+    etag = f'"{_progress_epoch}-v{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if _progress_cache["version"] != version:
+        _progress_cache.update(version=version, body=orjson.dumps(progress))
+    return Response(_progress_cache["body"], media_type="application/json", headers=headers)
+
+def format_event(snapshot):
+    return b"data: " + orjson.dumps(snapshot) + b"\n\n"
+
+# Route to push progress updates as server-sent events
+@app.get("/progress/stream")
+async def stream_progress():
+    async def event_generator():
+        subscriber = asyncio.Queue(maxsize=1)
+        progress_subscribers.add(subscriber)
+        try:
+            # Start with the current state so subscribers don't wait for the next update
+            snapshot = dict(progress)
+            yield format_event(snapshot)
+            while not snapshot["completed"] and snapshot["status"] != "idle":
+                try:
+                    snapshot = await asyncio.wait_for(subscriber.get(), PROGRESS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    snapshot = dict(progress)
+                yield format_event(snapshot)
+        finally:
+            progress_subscribers.discard(subscriber)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # SQLite3 database setup
 DATABASE_PATH = "codes.db"
 
+# Writes are queued as (rows, future) pairs and committed by a background writer thread, which folds
+# whatever is already queued into one transaction; each future resolves once its rows are committed,
+# or carries the error if they weren't
+WRITE_BATCH_SIZE = 1000
+
+# Connections are opened once: the writer thread owns a single read-write connection and
+# readers share a small pool of read-only ones
+READ_POOL_SIZE = 4
+
+def open_connection(read_only=False):
+    # Autocommit mode; transactions are managed explicitly
+    if read_only:
+        # Read-only connections don't contend with the writer under WAL
+        database = Path(DATABASE_PATH).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(database, uri=True, check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=30000000000;
+    """)
+    return conn
+
+def create_read_pool():
+    pool = queue.Queue()
+    for _ in range(READ_POOL_SIZE):
+        pool.put(open_connection(read_only=True))
+    return pool
+
+@contextmanager
+def pooled_connection(pool):
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+_write_conn = open_connection()
+_write_queue = queue.Queue()
+
+def extract_function_metadata(code_content):
+    # Parse the code content once to extract the function name and docstring
+    try:
+        parsed_code = ast.parse(code_content)
+    except Exception as e:
+        return "Unknown", "Parsing error: " + str(e)
+
+    # Stored code defines its function at module level, so only top-level statements need checking
+    for node in parsed_code.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return node.name, ast.get_docstring(node) or "No description available"
+    return "Unknown", "No description available"
+
 def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
+    # Runs before the writer thread starts, so it can use the writer's connection
+    _write_conn.execute('''
         CREATE TABLE IF NOT EXISTS codes (
             code_id TEXT PRIMARY KEY,
-            code_content TEXT
+            code_content TEXT,
+            function_name TEXT,
+            function_description TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
+
+    # Migrate databases created before the metadata columns existed
+    columns = {row[1] for row in _write_conn.execute('PRAGMA table_info(codes)')}
+    for column in ('function_name', 'function_description'):
+        if column not in columns:
+            _write_conn.execute(f'ALTER TABLE codes ADD COLUMN {column} TEXT')
+
+    # Backfill metadata for rows stored before it was cached
+    rows = _write_conn.execute('SELECT code_id, code_content FROM codes WHERE function_name IS NULL').fetchall()
+    if rows:
+        _write_conn.execute('BEGIN')
+        _write_conn.executemany(
+            'UPDATE codes SET function_name = ?, function_description = ? WHERE code_id = ?',
+            [(*extract_function_metadata(code_content), code_id) for code_id, code_content in rows]
+        )
+        _write_conn.execute('COMMIT')
+
+def _insert_rows(rows):
+    _write_conn.execute('BEGIN')
+    try:
+        _write_conn.executemany(
+            'INSERT OR REPLACE INTO codes (code_id, code_content, function_name, function_description) VALUES (?, ?, ?, ?)',
+            rows
+        )
+        _write_conn.execute('COMMIT')
+    except Exception:
+        _write_conn.execute('ROLLBACK')
+        raise
+
+def _db_writer():
+    while True:
+        batch = [_write_queue.get()]
+        row_count = len(batch[0][0])
+        # Callers wait for their commit, so take only what is already queued rather than waiting for more
+        while row_count < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+                row_count += len(batch[-1][0])
+            except queue.Empty:
+                break
+        try:
+            _insert_rows([row for rows, _ in batch for row in rows])
+            for _, future in batch:
+                future.set_result(None)
+        except Exception:
+            # Retry each queued write on its own so one bad write doesn't fail unrelated ones
+            for rows, future in batch:
+                try:
+                    _insert_rows(rows)
+                    future.set_result(None)
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+# Wait for queued writes to be committed before the process exits
+def flush_writes():
+    _write_queue.join()
 
 init_db()
+_read_pool = create_read_pool()
+threading.Thread(target=_db_writer, daemon=True).start()
+atexit.register(flush_writes)
+
+def hash_code(code_content):
+    # BLAKE3 IDs carry a "b3:" prefix so existing bare SHA-256 IDs still resolve
+    if blake3 is not None:
+        return "b3:" + blake3(code_content.encode()).hexdigest()
+    return hashlib.sha256(code_content.encode()).hexdigest()
+
+def store_codes(code_contents):
+    # Rows queued together are always committed in the same transaction
+    rows = []
+    for code_content in code_contents:
+        # Generate a unique identifier by hashing the code content
+        code_id = hash_code(code_content)
+        function_name, function_description = extract_function_metadata(code_content)
+        rows.append((code_id, code_content, function_name, function_description))
+    future = Future()
+    _write_queue.put((rows, future))
+    # Wait for the commit so a failed write surfaces as a tool error
+    future.result()
+    return [f"Code stored with ID: {row[0]}" for row in rows]
 
 def store_code(code_content):
-    # Generate a unique identifier using SHA-256 hash of the code content
-    code_id = hashlib.sha256(code_content.encode()).hexdigest()
-    
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO codes (code_id, code_content) VALUES (?, ?)', (code_id, code_content))
-    conn.commit()
-    conn.close()
-    return f"Code stored with ID: {code_id}"
+    return store_codes([code_content])[0]
 
 def retrieve_code(code_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT code_content FROM codes WHERE code_id = ?', (code_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with pooled_connection(_read_pool) as conn:
+        result = conn.execute('SELECT code_content FROM codes WHERE code_id = ?', (code_id,)).fetchone()
     if result:
         return result[0]
     else:
         return f"Code with ID {code_id} not found."
 
 def list_all_functions():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT code_id, code_content FROM codes')
-    results = cursor.fetchall()
-    conn.close()
-    
-    functions_list = []
-    for code_id, code_content in results:
-        try:
-            # Parse the code content to extract function name and description
-            function_name = "Unknown"
-            function_description = "No description available"
-            
-            # Assuming the code content is a valid Python function definition
-            # We can use ast (Abstract Syntax Trees) to parse the code and extract the function name and docstring
-            import ast
-            parsed_code = ast.parse(code_content)
-            for node in ast.walk(parsed_code):
-                if isinstance(node, ast.FunctionDef):
-                    function_name = node.name
-                    if node.body and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Str):
-                        function_description = node.body[0].value.s
-                    break
-            
-            functions_list.append({
-                "code_id": code_id,
-                "function_name": function_name,
-                "function_description": function_description
-            })
-        except Exception as e:
-            # If parsing fails, just add the code_id and content without name and description
-            functions_list.append({
-                "code_id": code_id,
-                "function_name": "Unknown",
-                "function_description": "Parsing error: " + str(e)
-            })
-    
-    return functions_list
+    with pooled_connection(_read_pool) as conn:
+        cursor = conn.execute('SELECT code_id, function_name, function_description FROM codes')
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
 # Available functions for the LLM
 available_functions = {
@@ -246,8 +608,8 @@ available_functions = {
     "list_all_functions": list_all_functions
 }
 
-# Define the tools for function calling
-tools = [
+# Define the tools for function calling (frozen so the spec is built once and never mutated)
+tools = (
     {
         "type": "function",
         "function": {
@@ -382,24 +744,208 @@ tools = [
             }
         }
     }
-]
+)
+
+# Model settings don't change between calls, so the completion kwargs and capability check are built once
+_COMPLETION_KWARGS = {"model": MODEL_NAME, "tools": tools, "tool_choice": "auto"}
+_SECOND_KWARGS = {"model": MODEL_NAME}
+
+try:
+    SUPPORTS_FUNCTION_CALLING = supports_function_calling(MODEL_NAME)
+except Exception:
+    SUPPORTS_FUNCTION_CALLING = False
 
 def read_instructions():
     instructions_file = os.path.join(BASE_DIR, 'instructions.md')
-    with open(instructions_file, 'r') as file:
-        return file.read()
+    return read_file(instructions_file)
+
+# Number of recent conversation messages sent alongside the bootstrap messages
+MESSAGE_WINDOW = 8
+
+def message_role(message):
+    if isinstance(message, dict):
+        return message.get("role")
+    return getattr(message, "role", None)
+
+def trim_messages(messages):
+    # Keep the instructions and user request plus the most recent turns
+    if len(messages) <= 2 + MESSAGE_WINDOW:
+        return
+    start = len(messages) - MESSAGE_WINDOW
+    # Don't split tool results from the assistant message that made the calls
+    while start > 2 and message_role(messages[start]) == "tool":
+        start -= 1
+    del messages[2:start]
+
+def summarize_history(iterations):
+    # Compact summary built locally so dropped turns still inform the LLM
+    tool_counts = {}
+    error_count = 0
+    for entry in iterations:
+        for result in entry["tool_results"]:
+            tool_counts[result["tool"]] = tool_counts.get(result["tool"], 0) + 1
+        error_count += len(entry["errors"])
+    tool_summary = ", ".join(f"{tool} x{count}" for tool, count in tool_counts.items()) or "none"
+    return f"Earlier: {len(iterations)} iterations, tool calls: {tool_summary}, errors: {error_count}"
+
+def build_prompt(messages, history_dict):
+    # Insert the history summary after the bootstrap messages so it reflects the current state.
+    # The last entry is the iteration in progress, which isn't history yet.
+    history_message = {"role": "system", "content": f"History:\n{summarize_history(history_dict['iterations'][:-1])}"}
+    return messages[:2] + [history_message] + messages[2:]
+
+# Cap for exponential backoff when the provider gives no retry-after hint
+MAX_RETRY_DELAY = 30
+
+# Consecutive rate-limit (429) responses per provider, shared across runs
+rate_limit_hits = {}
+
+def llm_provider(model):
+    try:
+        return get_llm_provider(model)[1]
+    except Exception:
+        return model
+
+def is_retryable_error(error):
+    # Rate limits, server errors, timeouts and dropped connections are worth waiting out;
+    # anything else (bad credentials, tool bugs) won't get better by sleeping
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and (status_code in (408, 429) or status_code >= 500)
+
+def retry_delay(error, attempt):
+    # Prefer the provider's own retry-after hint (within the cap), otherwise back off exponentially
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('retry-after')
+    try:
+        retry_after = float(retry_after)
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None and retry_after >= 0:
+        return min(retry_after, MAX_RETRY_DELAY)
+    return min(2 ** attempt, MAX_RETRY_DELAY)
+
+# Run a single tool call, returning (result, error)
+def call_tool(tool_call):
+    function_name = tool_call.function.name
+    function_to_call = available_functions.get(function_name)
+
+    if not function_to_call:
+        error_message = f"Tool '{function_name}' is not available."
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': 'No traceback available.'
+        }
+
+    try:
+        function_args = orjson.loads(tool_call.function.arguments)
+        return function_to_call(**function_args), None
+    except Exception as tool_error:
+        error_message = f"Error executing {function_name}: {tool_error}"
+        return None, {
+            'action': f'tool_call_{function_name}',
+            'error': error_message,
+            'traceback': traceback.format_exc()
+        }
+
+# Run a single tool call in a worker thread so filesystem work doesn't block the event loop
+async def execute_tool_call(tool_call):
+    return await asyncio.to_thread(call_tool, tool_call)
+
+def tool_call_path(tool_call):
+    try:
+        function_args = orjson.loads(tool_call.function.arguments)
+    except Exception:
+        return None
+    if not isinstance(function_args, dict):
+        return None
+    path = function_args.get("path") or function_args.get("file_path")
+    return os.path.abspath(path) if isinstance(path, str) else None
+
+# Calls that target the same path run one after another in order; everything else runs concurrently
+async def execute_tool_call_chains(tool_calls, indices, results):
+    chains = {}
+    for i in indices:
+        path = tool_call_path(tool_calls[i])
+        chains.setdefault(path if path is not None else i, []).append(i)
+
+    async def run_chain(chain):
+        for i in chain:
+            results[i] = await execute_tool_call(tool_calls[i])
+
+    await asyncio.gather(*(run_chain(chain) for chain in chains.values()))
+
+# Run all store_code calls from one turn as a single batched insert, returning (result, error) per call
+async def execute_store_code_calls(tool_calls):
+    results = []
+    code_contents = []
+    for tool_call in tool_calls:
+        try:
+            code_contents.append(orjson.loads(tool_call.function.arguments)["code_content"])
+            results.append(None)
+        except Exception as tool_error:
+            results.append((None, {
+                'action': 'tool_call_store_code',
+                'error': f"Error executing store_code: {tool_error}",
+                'traceback': traceback.format_exc()
+            }))
+    if not code_contents:
+        return results
+
+    try:
+        responses = iter(await asyncio.to_thread(store_codes, code_contents))
+    except Exception as tool_error:
+        error = {
+            'action': 'tool_call_store_code',
+            'error': f"Error executing store_code: {tool_error}",
+            'traceback': traceback.format_exc()
+        }
+        return [result or (None, error) for result in results]
+    return [result or (next(responses), None) for result in results]
+
+# Execute every tool call from one LLM turn, returning (result, error) in call order
+async def execute_tool_calls(tool_calls):
+    results = [None] * len(tool_calls)
+    directory_calls = [i for i, tool_call in enumerate(tool_calls) if tool_call.function.name == "create_directory"]
+    store_calls = [i for i, tool_call in enumerate(tool_calls) if tool_call.function.name == "store_code"]
+    completion_calls = [i for i, tool_call in enumerate(tool_calls) if tool_call.function.name == "task_completed"]
+    other_calls = [
+        i for i, tool_call in enumerate(tool_calls)
+        if tool_call.function.name not in ("create_directory", "store_code", "task_completed")
+    ]
+
+    # Directories are created first so files written in the same turn have somewhere to go
+    await execute_tool_call_chains(tool_calls, directory_calls, results)
+
+    # All store_code calls in the turn share one insert transaction
+    store_results, _ = await asyncio.gather(
+        execute_store_code_calls([tool_calls[i] for i in store_calls]),
+        execute_tool_call_chains(tool_calls, other_calls, results)
+    )
+    for i, result in zip(store_calls, store_results):
+        results[i] = result
 
-def run_main_loop(user_input):
+    # task_completed updates progress, so it runs last and on the event loop rather than in a worker thread
+    for i in completion_calls:
+        results[i] = call_tool(tool_calls[i])
+
+    return results
+
+async def run_main_loop(user_input):
     history_dict = {"iterations": []}
 
-    if not supports_function_calling(MODEL_NAME):
-        progress["status"] = "error"
-        progress["output"] = "Model does not support function calling."
-        progress["completed"] = True
+    if not SUPPORTS_FUNCTION_CALLING:
+        publish_progress(status="error", output="Model does not support function calling.", completed=True)
         return "Model does not support function calling."
 
     max_iterations = progress["max_iterations"]
     iteration = 0
+    attempt = 0
+    provider = llm_provider(MODEL_NAME)
 
     instructions = read_instructions()
 
@@ -408,67 +954,67 @@ def run_main_loop(user_input):
             "role": "system",
             "content": instructions
         },
-        {"role": "user", "content": user_input},
-        {"role": "system", "content": f"History:\n{json.dumps(history_dict, indent=2)}"}
+        {"role": "user", "content": user_input}
     ]
 
     output = ""
 
-    while iteration < max_iterations:
-        progress["iteration"] = iteration + 1
-        current_iteration = {
-            "iteration": iteration + 1,
-            "actions": [],
-            "llm_responses": [],
-            "tool_results": [],
-            "errors": []
-        }
-        history_dict['iterations'].append(current_iteration)
+    run_id = uuid.uuid4().hex
 
-        try:
-            response = completion(
-                model=MODEL_NAME,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto"
-            )
-
-            if not response.choices[0].message:
-                error = response.get('error', 'Unknown error')
-                current_iteration['errors'].append({'action': 'llm_completion', 'error': error})
-                log_to_file(history_dict)
-                sleep(5)
-                iteration += 1
-                continue
-
-            response_message = response.choices[0].message
-            content = response_message.content or ""
-            current_iteration['llm_responses'].append(content)
-
-            output += f"\n<h2>Iteration {iteration + 1}:</h2>\n"
-
-            tool_calls = response_message.tool_calls
-
-            if tool_calls:
-                output += "<strong>Tool Call:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
-
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_to_call = available_functions.get(function_name)
-
-                    if not function_to_call:
-                        error_message = f"Tool '{function_name}' is not available."
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': 'No traceback available.'
-                        })
-                        continue
+    with open_log() as log_file:
+        log_to_file(log_file, run_id, {
+            "event": "run_started",
+            "started_at": formatdate(time.time(), usegmt=True),
+            "model": MODEL_NAME
+        })
+        while iteration < max_iterations:
+            trim_messages(messages)
+            delay = 0
+            publish_progress(iteration=iteration + 1)
+            current_iteration = {
+                "iteration": iteration + 1,
+                "actions": [],
+                "llm_responses": [],
+                "tool_results": [],
+                "errors": []
+            }
+            history_dict['iterations'].append(current_iteration)
+
+            try:
+                response = await acompletion(messages=build_prompt(messages, history_dict), **_COMPLETION_KWARGS)
+
+                if not response.choices[0].message:
+                    error = response.get('error', 'Unknown error')
+                    current_iteration['errors'].append({'action': 'llm_completion', 'error': error})
+                    log_to_file(log_file, run_id, current_iteration)
+                    attempt += 1
+                    await asyncio.sleep(retry_delay(None, attempt))
+                    iteration += 1
+                    continue
+
+                response_message = response.choices[0].message
+                content = response_message.content or ""
+                current_iteration['llm_responses'].append(content)
+
+                output += f"\n<h2>Iteration {iteration + 1}:</h2>\n"
+
+                tool_calls = response_message.tool_calls
+
+                if tool_calls:
+                    output += "<strong>Tool Call:</strong>\n<p>" + content + "</p>\n"
+                    messages.append(response_message)
+
+                    # Tool calls within a turn are independent, so run them concurrently off the event loop
+                    results = await execute_tool_calls(tool_calls)
+                    task_done = False
+
+                    for tool_call, (function_response, error) in zip(tool_calls, results):
+                        function_name = tool_call.function.name
+
+                        if error:
+                            current_iteration['errors'].append(error)
+                            continue
 
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
-                        function_response = function_to_call(**function_args)
                         current_iteration['tool_results'].append({
                             'tool': function_name,
                             'result': function_response
@@ -477,60 +1023,55 @@ def run_main_loop(user_input):
                         messages.append(
                             {"tool_call_id": tool_call.id, "role": "tool", "name": function_name, "content": function_response}
                         )
-
                         if function_name == "task_completed":
-                            progress["status"] = "completed"
-                            progress["completed"] = True
-                            output += "\n<h2>COMPLETE</h2>\n"
-                            progress["output"] = output
-                            log_to_file(history_dict)
-                            return output
-
-                    except Exception as tool_error:
-                        error_message = f"Error executing {function_name}: {tool_error}"
-                        current_iteration['errors'].append({
-                            'action': f'tool_call_{function_name}',
-                            'error': error_message,
-                            'traceback': traceback.format_exc()
-                        })
+                            task_done = True
 
-                second_response = completion(
-                    model=MODEL_NAME,
-                    messages=messages
-                )
-                if second_response.choices and second_response.choices[0].message:
-                    second_response_message = second_response.choices[0].message
-                    content = second_response_message.content or ""
-                    current_iteration['llm_responses'].append(content)
-                    output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                    messages.append(second_response_message)
-                else:
-                    error = second_response.get('error', 'Unknown error in second LLM response.')
-                    current_iteration['errors'].append({'action': 'second_llm_completion', 'error': error})
+                    # Every result of the turn is recorded before finishing
+                    if task_done:
+                        output += "\n<h2>COMPLETE</h2>\n"
+                        publish_progress(status="completed", completed=True, output=output)
+                        log_to_file(log_file, run_id, current_iteration)
+                        return output
 
-            else:
-                output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
-                messages.append(response_message)
+                    second_response = await acompletion(messages=build_prompt(messages, history_dict), **_SECOND_KWARGS)
+                    if second_response.choices and second_response.choices[0].message:
+                        second_response_message = second_response.choices[0].message
+                        content = second_response_message.content or ""
+                        current_iteration['llm_responses'].append(content)
+                        output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
+                        messages.append(second_response_message)
+                    else:
+                        error = second_response.get('error', 'Unknown error in second LLM response.')
+                        current_iteration['errors'].append({'action': 'second_llm_completion', 'error': error})
 
-            progress["output"] = output
+                else:
+                    output += "<strong>LLM Response:</strong>\n<p>" + content + "</p>\n"
+                    messages.append(response_message)
 
-        except Exception as e:
-            error = str(e)
-            current_iteration['errors'].append({
-                'action': 'main_loop',
-                'error': error,
-                'traceback': traceback.format_exc()
-            })
+                publish_progress(output=output)
+                attempt = 0
+                rate_limit_hits.pop(provider, None)
 
-        iteration += 1
-        log_to_file(history_dict)
-        sleep(2)
+            except Exception as e:
+                error = str(e)
+                current_iteration['errors'].append({
+                    'action': 'main_loop',
+                    'error': error,
+                    'traceback': traceback.format_exc()
+                })
+                if is_retryable_error(e):
+                    attempt += 1
+                    if getattr(e, 'status_code', None) == 429:
+                        rate_limit_hits[provider] = rate_limit_hits.get(provider, 0) + 1
+                        attempt = max(attempt, rate_limit_hits[provider])
+                    delay = retry_delay(e, attempt)
 
-    if iteration >= max_iterations:
-        progress["status"] = "completed"
+            iteration += 1
+            log_to_file(log_file, run_id, current_iteration)
+            if delay:
+                await asyncio.sleep(delay)
 
-    progress["completed"] = True
-    progress["status"] = "completed"
+    publish_progress(completed=True, status="completed")
 
     return output
 